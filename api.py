@@ -1,35 +1,179 @@
+import contextlib
+import functools
 import io
+import itertools
+import queue
 import socket
 import struct
+import threading
 import zlib
 from enum import Enum
-from typing import Any, BinaryIO, NamedTuple
+from typing import Any, BinaryIO, Callable, Iterator, NamedTuple
 import datetime
 
 from binary_reader import BinaryReader
 
 
-def _format_time(timestamp: int) -> str:
-    ts = str(timestamp)
-    time = ts[:-6] + ':'
-    if int(ts[-6:-4]) < 60:
-        time += f'{ts[-6:-4]}:{int(ts[-4:] * 60) / 10000:06.3f}'
-    else:
-        time += f'{int(int(ts[-6:]) * 60 / 1000000):02d}:{(int(ts[-6:]) * 60 % 1000000) * 60 / 1000000:06.3f}'
-    return time
-
-
-def _get_time(reader: BinaryReader) -> datetime.time:
-    tminutes = reader.u16
-    return datetime.time(tminutes // 60, tminutes % 60)
+# 请求包格式
+_PKT_STOCKS_LIST = struct.Struct('<HH')
+_PKT_KLINE = struct.Struct('<HIHHHH6sHHHHIIH')
+_PKT_MINUTE = struct.Struct('<H6sI')
+_PKT_HISTORY_MINUTE = struct.Struct('<IB6s')
+_PKT_TRANSACTION = struct.Struct('<H6sHH')
+_PKT_HISTORY_TRANSACTION = struct.Struct('<IH6sHH')
+_PKT_COMPANY_INFO_ENTRY = struct.Struct('<H6sI')
+_PKT_COMPANY_INFO_CONTENT = struct.Struct('<H6sH80sIII')
+_PKT_STOCK = struct.Struct('<B6s')
 
+# 响应包格式
+_RSP_HEADER = struct.Struct('<IIIHH')
+_U16 = struct.Struct('<H')
 
-def _calc_price(base_value: float, offset: float) -> float:
-    return (base_value + offset) / 100
 
-
-def _calc_price1k(base_value: float, offset: float) -> float:
-    return (base_value + offset) / 1000
+def _format_time(timestamp: int) -> str:
+    # 高位为小时，低6位有两种格式：
+    # 前两位小于60时为 2位分钟 + 4位分钟小数，否则整体为6位小时小数
+    hour, rest = divmod(timestamp, 1000000)
+    minute, fraction = divmod(rest, 10000)
+    if minute < 60:
+        return f'{hour}:{minute:02d}:{fraction * 60 / 10000:06.3f}'
+    minute, fraction = divmod(rest * 60, 1000000)
+    return f'{hour}:{minute:02d}:{fraction * 60 / 1000000:06.3f}'
+
+
+# datetime对象不可变，可以安全复用；反复拉取同一段K线时大部分时刻可直接命中缓存
+@functools.lru_cache(maxsize=0x1000)
+def _intraday_datetime(zipday: int, tminutes: int) -> datetime.datetime:
+    month, day = divmod(zipday & 0x7ff, 100)
+    hour, minute = divmod(tminutes, 60)
+    return datetime.datetime((zipday >> 11) + 2004, month, day, hour, minute)
+
+
+@functools.lru_cache(maxsize=0x1000)
+def _daily_datetime(zipday: int) -> datetime.datetime:
+    year, month_day = divmod(zipday, 10000)
+    month, day = divmod(month_day, 100)
+    return datetime.datetime(year, month, day, 15)
+
+
+def _get_intraday_datetime(reader: BinaryReader) -> datetime.datetime:
+    return _intraday_datetime(reader.u16, reader.u16)
+
+
+def _get_daily_datetime(reader: BinaryReader) -> datetime.datetime:
+    return _daily_datetime(reader.u32)
+
+
+_K_LINE_INTRADAY_DATE = struct.Struct('<HH')
+_K_LINE_DAILY_DATE = struct.Struct('<I')
+# 成交量、成交额
+_K_LINE_TAIL = struct.Struct('<ff')
+# 成交量、成交额、上涨数、下跌数
+_K_LINE_INDEX_TAIL = struct.Struct('<ffHH')
+
+
+def _is_index_k_line(buf: bytes, count: int) -> bool:
+    # 指数K线每行末尾多出上涨数和下跌数，按指数格式跳读一遍，恰好读完整个响应即为指数
+    size = len(buf)
+    pos = _U16.size
+    for _ in range(count):
+        pos += _K_LINE_DAILY_DATE.size
+        for _ in range(4):
+            while pos < size and buf[pos] & 0x80:
+                pos += 1
+            pos += 1
+        pos += _K_LINE_INDEX_TAIL.size
+        if pos > size:
+            return False
+    return pos == size
+
+
+# rows中每行的第2~5项依次为开盘、收盘、最高、最低价的增量
+# 每行的基准价是之前所有行开盘价增量与收盘价增量之和，用前缀和一次算出
+def _k_line_prices(rows: list[tuple]) -> list[tuple[float, float, float, float]]:
+    bases = itertools.accumulate((row[1] + row[2] for row in rows), initial=0)
+    return [((open_diff + base) / 1000,
+             (open_diff + base + close_diff) / 1000,
+             (open_diff + base + high_diff) / 1000,
+             (open_diff + base + low_diff) / 1000)
+            for (_, open_diff, close_diff, high_diff, low_diff, *_), base in zip(rows, bases)]
+
+
+# 直接在原始字节上连续解析count个vint，格式见BinaryReader.vint
+# 返回解析出的整数及下一个字节的位置
+def _read_vints(buf: bytes, pos: int, count: int) -> tuple[list[int], int]:
+    result = []
+    for _ in range(count):
+        byte = buf[pos]
+        pos += 1
+        value = byte & 0x3f
+        sign = byte & 0x40
+        pos_byte = 6
+        while byte & 0x80:
+            byte = buf[pos]
+            pos += 1
+            value += (byte & 0x7f) << pos_byte
+            pos_byte += 7
+        result.append(-value if sign else value)
+    return result, pos
+
+
+# 按股票数量缓存请求包的格式，整个请求包只需一次pack
+@functools.lru_cache
+def _quotes_package(stocks_count: int) -> struct.Struct:
+    return struct.Struct('<HIHHIIHH' + 'B6s' * stocks_count)
+
+
+_QUOTE_HEAD = struct.Struct('<B6sH')
+_QUOTE_AMOUNT = struct.Struct('<f')
+_QUOTE_TAIL = struct.Struct('<hH')
+
+
+def _parse_quotes(buf: bytes, pos: int, count: int) -> list[tuple]:
+    # 先将每只股票的原始字段按顺序解析成元组，再统一构造结果
+    rows = []
+    for _ in range(count):
+        head = _QUOTE_HEAD.unpack_from(buf, pos)
+        prices, pos = _read_vints(buf, pos + _QUOTE_HEAD.size, 9)
+        amount = _QUOTE_AMOUNT.unpack_from(buf, pos)
+        orders, pos = _read_vints(buf, pos + _QUOTE_AMOUNT.size, 24)
+        reserved = _U16.unpack_from(buf, pos)
+        reserved_vints, pos = _read_vints(buf, pos + _U16.size, 4)
+        tail = _QUOTE_TAIL.unpack_from(buf, pos)
+        pos += _QUOTE_TAIL.size
+        rows.append((*head, *prices, *amount, *orders, *reserved, *reserved_vints, *tail))
+    return rows
+
+
+def _parse_minute_prices(buf: bytes, pos: int, count: int) -> list['MinutePrice']:
+    # 每行为 价格增量、保留、成交量 三个vint，一次性解析后按列处理
+    values, _ = _read_vints(buf, pos, count * 3)
+    prices = itertools.accumulate(values[0::3])
+    return [MinutePrice(price / 100, volume) for price, volume in zip(prices, values[2::3])]
+
+
+def _parse_trades(buf: bytes, pos: int, count: int, vints_per_row: int) -> list['Trade']:
+    # 每行为 时间(u16)、价格增量、成交量、num、buyorsell 及可能的保留vint
+    tminutes_list = []
+    rows = []
+    for _ in range(count):
+        tminutes, = _U16.unpack_from(buf, pos)
+        row, pos = _read_vints(buf, pos + _U16.size, vints_per_row)
+        tminutes_list.append(tminutes)
+        rows.append(row)
+    prices = itertools.accumulate(row[0] for row in rows)
+    return [Trade(datetime.time(tminutes // 60, tminutes % 60), price / 100, *row[1:4])
+            for tminutes, price, row in zip(tminutes_list, prices, rows)]
+
+
+_STOCKS_LIST_ENTRY = struct.Struct('<6sH8s4sBf4s')
+
+_FINANCE_INFO = struct.Struct('<2xB6sfHHII30f')
+# 以万为单位的字段，顺序与_FINANCE_INFO中的28个f32一致
+_FINANCE_INFO_KEYS = ('总股本', '国家股', '发起人法人股', '法人股', 'B股', 'H股', '职工股',
+                      '总资产', '流动资产', '固定资产', '无形资产', '股东人数', '流动负债', '长期负债',
+                      '资本公积金', '净资产', '主营收入', '主营利润', '营收账款', '营业利润', '投资收入',
+                      '经营现金流', '总现金流', '存活', '利润总和', '税后利润', '净利润', '未分配利润')
 
 
 class DataEntry(NamedTuple):
@@ -42,6 +186,79 @@ class DataEntry(NamedTuple):
     volume: float
 
 
+class Quote(NamedTuple):
+    市场: 'Api.Market'
+    股票代码: bytes
+    active1: int
+    股价: float
+    昨日收盘价: float
+    今日开盘价: float
+    最高价: float
+    最低价: float
+    服务器时间: str
+    reserved_bytes1: int
+    成交量: int
+    当前成交量: int
+    成交额: float
+    内盘: int
+    外盘: int
+    reserved_bytes2: int
+    reserved_bytes3: int
+    买1: float
+    卖1: float
+    买1成交量: int
+    卖1成交量: int
+    买2: float
+    卖2: float
+    买2成交量: int
+    卖2成交量: int
+    买3: float
+    卖3: float
+    买3成交量: int
+    卖3成交量: int
+    买4: float
+    卖4: float
+    买4成交量: int
+    卖4成交量: int
+    买5: float
+    卖5: float
+    买5成交量: int
+    卖5成交量: int
+    reserved_bytes4: int
+    reserved_bytes5: int
+    reserved_bytes6: int
+    reserved_bytes7: int
+    reserved_bytes8: int
+    增速: float
+    active2: int
+
+
+class KLine(NamedTuple):
+    时刻: datetime.datetime
+    开盘价: float
+    收盘价: float
+    最高价: float
+    最低价: float
+    成交量: float
+    成交额: float
+    # 仅指数有以下两项
+    上涨数: int | None = None
+    下跌数: int | None = None
+
+
+class MinutePrice(NamedTuple):
+    价格: float
+    成交量: int
+
+
+class Trade(NamedTuple):
+    时间: datetime.time
+    价格: float
+    成交量: int
+    num: int
+    buyorsell: int
+
+
 class Api:
     class Market(Enum):
         SZ = 0
@@ -78,26 +295,46 @@ class Api:
         SendPutWarrant = 14  # 送认沽权证
 
     _client: socket.socket | None
+    _rfile: BinaryIO | None
 
     RSP_HEADER_LENGTH = 0x10
+    SOCKET_BUFFER_SIZE = 0x40000
+    RECV_BUFFER_SIZE = 0x10000
 
     def __init__(self, server: tuple[str, int] | None = None, connection_timeout: float = 1.0) -> None:
+        # 协议为严格的一问一答，多线程共用同一连接时需保证请求与响应成对
+        self._lock = threading.Lock()
         if server:
             host, port = server
             self._client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._client.settimeout(connection_timeout)
+            # 收发缓冲区需在connect之前设置才能影响TCP窗口大小
+            self._client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.SOCKET_BUFFER_SIZE)
+            self._client.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SOCKET_BUFFER_SIZE)
             self._client.connect((host, port))
-            self._hello()
+            # 请求包都很小且为一问一答，关闭Nagle算法避免发送被延迟
+            self._client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._rfile = self._client.makefile('rb', buffering=self.RECV_BUFFER_SIZE)
+            try:
+                self._hello()
+            except BaseException:
+                self.close()
+                raise
         else:
             self._client = None
+            self._rfile = None
 
     def _hello(self) -> None:
-        self._req(b'\x0c\x02\x18\x93\x00\x01\x03\x00\x03\x00\x0d\x00\x01')
-        self._req(b'\x0c\x02\x18\x94\x00\x01\x03\x00\x03\x00\x0d\x00\x02')
-        self._req(b'\x0c\x03\x18\x99\x00\x01\x20\x00\x20\x00\xdb\x0f\xd5'
-                  b'\xd0\xc9\xcc\xd6\xa4\xa8\xaf\x00\x00\x00\x8f\xc2\x25'
-                  b'\x40\x13\x00\x00\xd5\x00\xc9\xcc\xbd\xf0\xd7\xea\x00'
-                  b'\x00\x00\x02')
+        # 三个握手包互不依赖，一次性发出后再依次读取各自的响应
+        packages = (b'\x0c\x02\x18\x93\x00\x01\x03\x00\x03\x00\x0d\x00\x01',
+                    b'\x0c\x02\x18\x94\x00\x01\x03\x00\x03\x00\x0d\x00\x02',
+                    b'\x0c\x03\x18\x99\x00\x01\x20\x00\x20\x00\xdb\x0f\xd5'
+                    b'\xd0\xc9\xcc\xd6\xa4\xa8\xaf\x00\x00\x00\x8f\xc2\x25'
+                    b'\x40\x13\x00\x00\xd5\x00\xc9\xcc\xbd\xf0\xd7\xea\x00'
+                    b'\x00\x00\x02')
+        self._client.sendall(b''.join(packages))
+        for _ in packages:
+            self._recv()
 
     def get_stocks_count(self, market: Market) -> int:
         reader = self._req(
@@ -105,262 +342,144 @@ class Api:
         return reader.u16
 
     def get_stocks_list(self, market: Market, start: int) -> list[dict[str, Any]]:
-        package = b'\x0c\x01\x18\x64\x01\x01\x06\x00\x06\x00\x50\x04' + struct.pack('<HH', market.value, start)
-        reader = self._req(package)
-        stocks_count = reader.u16
-        stocks = []
-        for _ in range(stocks_count):
-            stocks.append({
-                '股票代码': reader.read(6).decode(),
-                'volunit': reader.u16,
-                '股票名称': reader.read(8).decode('gbk').rstrip('\x00'),
-                'reserved_bytes1': reader.read(4),
-                'decimal_point': reader.u8,
-                '昨日收盘价': reader.f32,
-                'reserved_bytes2': reader.read(4)
-            })
-        return stocks
-
-    def get_stock_quotes(self, stocks: list[tuple[Market, str]]) -> list[dict[str, Any]]:
+        package = b'\x0c\x01\x18\x64\x01\x01\x06\x00\x06\x00\x50\x04' + _PKT_STOCKS_LIST.pack(market.value, start)
+        data = self._req_raw(package)
+        stocks_count, = _U16.unpack_from(data)
+        entries = list(_STOCKS_LIST_ENTRY.iter_unpack(
+            data[_U16.size:_U16.size + stocks_count * _STOCKS_LIST_ENTRY.size]))
+        # 名称为右侧补\x00的定长GBK字符串，\x00和\x1f在GBK中只会作为单字节字符出现，
+        # 因此可以用\x1f拼接后一次性去掉\x00并解码，再按\x1f切分
+        names = b'\x1f'.join(entry[2] for entry in entries).translate(None, b'\x00').decode('gbk').split('\x1f')
+        return [{
+            '股票代码': code.decode(),
+            'volunit': volunit,
+            '股票名称': name,
+            'reserved_bytes1': reserved1,
+            'decimal_point': decimal_point,
+            '昨日收盘价': pre_close,
+            'reserved_bytes2': reserved2
+        } for (code, volunit, _, reserved1, decimal_point, pre_close, reserved2), name in zip(entries, names)]
+
+    def get_stock_quotes(self, stocks: list[tuple[Market, str]]) -> list[Quote]:
         stocks_count = len(stocks)
         package_size = stocks_count * 7 + 12
-        package = bytearray(struct.pack('<HIHHIIHH', 0x10c, 0x02006320,
-                                        package_size, package_size,
-                                        0x5053e, 0, 0,
-                                        stocks_count))
-        for market, stock in stocks:
-            package.extend(struct.pack('<B6s', market.value, stock.encode()))
-        reader = self._req(package)
-        reader.skip(2)
-        stocks_count = reader.u16
-        result = []
-
-        for _ in range(stocks_count):
-            market, stock, active1 = struct.unpack('<B6sH', reader.read(9))
-            price = reader.vint
-            result.append({
-                '市场': self.Market(market),
-                '股票代码': stock,
-                'active1': active1,
-                '股价': _calc_price(price, 0),
-                '昨日收盘价': _calc_price(price, reader.vint),
-                '今日开盘价': _calc_price(price, reader.vint),
-                '最高价': _calc_price(price, reader.vint),
-                '最低价': _calc_price(price, reader.vint),
-                '服务器时间': _format_time(reader.vint),
-                'reserved_bytes1': reader.vint,
-                '成交量': reader.vint,
-                '当前成交量': reader.vint,
-                '成交额': reader.f32,
-                '内盘': reader.vint,
-                '外盘': reader.vint,
-                'reserved_bytes2': reader.vint,
-                'reserved_bytes3': reader.vint,
-                '买1': _calc_price(price, reader.vint),
-                '卖1': _calc_price(price, reader.vint),
-                '买1成交量': reader.vint,
-                '卖1成交量': reader.vint,
-                '买2': _calc_price(price, reader.vint),
-                '卖2': _calc_price(price, reader.vint),
-                '买2成交量': reader.vint,
-                '卖2成交量': reader.vint,
-                '买3': _calc_price(price, reader.vint),
-                '卖3': _calc_price(price, reader.vint),
-                '买3成交量': reader.vint,
-                '卖3成交量': reader.vint,
-                '买4': _calc_price(price, reader.vint),
-                '卖4': _calc_price(price, reader.vint),
-                '买4成交量': reader.vint,
-                '卖4成交量': reader.vint,
-                '买5': _calc_price(price, reader.vint),
-                '卖5': _calc_price(price, reader.vint),
-                '买5成交量': reader.vint,
-                '卖5成交量': reader.vint,
-                'reserved_bytes4': reader.u16,
-                'reserved_bytes5': reader.vint,
-                'reserved_bytes6': reader.vint,
-                'reserved_bytes7': reader.vint,
-                'reserved_bytes8': reader.vint,
-                '增速': reader.i16 / 100,
-                'active2': reader.u16
-            })
-        return result
-
-    def get_k_line(self, category: KLineCategory, market: Market, stock: str, start: int, count: int) -> list[
-        dict[str, Any]]:
-        reader = self._req(struct.pack('<HIHHHH6sHHHHIIH',
-                                       0x10c, 0x01016408, 0x1c, 0x1c, 0x052d,
-                                       market.value,
-                                       stock.encode(),
-                                       category.value,
-                                       1,
-                                       start, count,
-                                       0, 0, 0))
-        try:  # 尝试作为指数
-            count = reader.u16
-            klines = []
-            pre_diff_base = 0
-            for _ in range(count):
-                date = self._get_datetime(category, reader)
-                price_open_diff = reader.vint
-                price_close_diff = reader.vint
-                price_high_diff = reader.vint
-                price_low_diff = reader.vint
-                price_open = _calc_price1k(price_open_diff, pre_diff_base)
-                price_open_diff += pre_diff_base
-
-                pre_diff_base = price_open_diff + price_close_diff
-                klines.append({
-                    '时刻': date,
-                    '开盘价': price_open,
-                    '收盘价': _calc_price1k(price_open_diff, price_close_diff),
-                    '最高价': _calc_price1k(price_open_diff, price_high_diff),
-                    '最低价': _calc_price1k(price_open_diff, price_low_diff),
-                    '成交量': reader.f32,
-                    '成交额': reader.f32,
-                    '上涨数': reader.u16,
-                    '下跌数': reader.u16
-                })
-            return klines
-        except ValueError:  # 不是指数
-            reader.pos = 0
-            count = reader.u16
-            klines = []
-            pre_diff_base = 0
-            for _ in range(count):
-                date = self._get_datetime(category, reader)
-                price_open_diff = reader.vint
-                price_close_diff = reader.vint
-                price_high_diff = reader.vint
-                price_low_diff = reader.vint
-                price_open = _calc_price1k(price_open_diff, pre_diff_base)
-                price_open_diff += pre_diff_base
-
-                pre_diff_base = price_open_diff + price_close_diff
-                klines.append({
-                    '时刻': date,
-                    '开盘价': price_open,
-                    '收盘价': _calc_price1k(price_open_diff, price_close_diff),
-                    '最高价': _calc_price1k(price_open_diff, price_high_diff),
-                    '最低价': _calc_price1k(price_open_diff, price_low_diff),
-                    '成交量': reader.f32,
-                    '成交额': reader.f32,
-                })
-            return klines
-
-    def get_minute_data(self, market: Market, stock: str) -> list[dict[str, Any]]:
-        reader = self._req(
-            b'\x0c\x1b\x08\x00\x01\x01\x0e\x00\x0e\x00\x1d\x05' + struct.pack('<H6sI', market.value, stock.encode(), 0))
-        count = reader.u16
-        last_price = 0
-        reader.skip(2)
-        prices = []
+        package = _quotes_package(stocks_count).pack(0x10c, 0x02006320,
+                                                     package_size, package_size,
+                                                     0x5053e, 0, 0,
+                                                     stocks_count,
+                                                     *itertools.chain.from_iterable(
+                                                         (market.value, stock.encode()) for market, stock in stocks))
+        data = self._req_raw(package)
+        stocks_count, = _U16.unpack_from(data, 2)
+        return [Quote(
+            _MARKETS[market], stock, active1,
+            price / 100, (price + pre_close) / 100, (price + open_) / 100,
+            (price + high) / 100, (price + low) / 100,
+            _format_time(server_time), reserved1, volume, cur_volume, amount,
+            inner, outer, reserved2, reserved3,
+            (price + bid1) / 100, (price + ask1) / 100, bid_vol1, ask_vol1,
+            (price + bid2) / 100, (price + ask2) / 100, bid_vol2, ask_vol2,
+            (price + bid3) / 100, (price + ask3) / 100, bid_vol3, ask_vol3,
+            (price + bid4) / 100, (price + ask4) / 100, bid_vol4, ask_vol4,
+            (price + bid5) / 100, (price + ask5) / 100, bid_vol5, ask_vol5,
+            reserved4, reserved5, reserved6, reserved7, reserved8,
+            speed / 100, active2
+        ) for (market, stock, active1,
+               price, pre_close, open_, high, low, server_time, reserved1, volume, cur_volume,
+               amount,
+               inner, outer, reserved2, reserved3,
+               bid1, ask1, bid_vol1, ask_vol1,
+               bid2, ask2, bid_vol2, ask_vol2,
+               bid3, ask3, bid_vol3, ask_vol3,
+               bid4, ask4, bid_vol4, ask_vol4,
+               bid5, ask5, bid_vol5, ask_vol5,
+               reserved4,
+               reserved5, reserved6, reserved7, reserved8,
+               speed, active2) in _parse_quotes(data, 4, stocks_count)]
+
+    def get_k_line(self, category: KLineCategory, market: Market, stock: str, start: int, count: int) -> list[KLine]:
+        data = self._req_raw(_PKT_KLINE.pack(0x10c, 0x01016408, 0x1c, 0x1c, 0x052d,
+                                             market.value,
+                                             stock.encode(),
+                                             category.value,
+                                             1,
+                                             start, count,
+                                             0, 0, 0))
+        count, = _U16.unpack_from(data)
+        date_format, make_datetime = self._k_line_date_format(category)
+        tail = _K_LINE_INDEX_TAIL if _is_index_k_line(data, count) else _K_LINE_TAIL
+        rows = []
+        pos = _U16.size
         for _ in range(count):
-            price_raw = reader.vint
-            _reserved1 = reader.vint
-            last_price += price_raw
-            prices.append({
-                '价格': last_price / 100,
-                '成交量': reader.vint
-            })
-        return prices
-
-    def get_history_minute_data(self, market: Market, stock: str, date: int) -> list[dict[str, Any]]:
-        reader = self._req(
-            b'\x0c\x01\x30\x00\x01\x01\x0d\x00\x0d\x00\xb4\x0f' + struct.pack('<IB6s', date, market.value,
-                                                                              stock.encode()))
-        count = reader.u16
-        last_price = 0
-        reader.skip(4)
-        prices = []
-        for _ in range(count):
-            price_raw = reader.vint
-            _reserved1 = reader.vint
-            last_price += price_raw
-            prices.append({
-                '价格': last_price / 100,
-                '成交量': reader.vint
-            })
-        return prices
-
-    def get_transaction_data(self, market: Market, stock: str, start: int, count: int) -> list[dict[str, Any]]:
-        reader = self._req(
-            b'\x0c\x17\x08\x01\x01\x01\x0e\x00\x0e\x00\xc5\x0f' + struct.pack('<H6sHH', market.value, stock.encode(),
-                                                                              start, count))
-        count = reader.u16
-        last_price = 0
-        trades = []
-        for _ in range(count):
-            time = _get_time(reader)
-            last_price += reader.vint
-
-            trades.append({
-                '时间': time,
-                '价格': last_price / 100,
-                '成交量': reader.vint,
-                'num': reader.vint,
-                'buyorsell': reader.vint
-            })
-            _reserved1 = reader.vint
-        return trades
+            date = make_datetime(*date_format.unpack_from(data, pos))
+            diffs, pos = _read_vints(data, pos + date_format.size, 4)
+            rows.append((date, *diffs, *tail.unpack_from(data, pos)))
+            pos += tail.size
+        return [KLine(date, *prices, *rest)
+                for (date, _, _, _, _, *rest), prices in zip(rows, _k_line_prices(rows))]
+
+    def get_minute_data(self, market: Market, stock: str) -> list[MinutePrice]:
+        data = self._req_raw(
+            b'\x0c\x1b\x08\x00\x01\x01\x0e\x00\x0e\x00\x1d\x05' + _PKT_MINUTE.pack(market.value, stock.encode(), 0))
+        count, = _U16.unpack_from(data)
+        return _parse_minute_prices(data, 4, count)
+
+    def get_history_minute_data(self, market: Market, stock: str, date: int) -> list[MinutePrice]:
+        data = self._req_raw(
+            b'\x0c\x01\x30\x00\x01\x01\x0d\x00\x0d\x00\xb4\x0f' + _PKT_HISTORY_MINUTE.pack(date, market.value,
+                                                                                           stock.encode()))
+        count, = _U16.unpack_from(data)
+        return _parse_minute_prices(data, 6, count)
+
+    def get_transaction_data(self, market: Market, stock: str, start: int, count: int) -> list[Trade]:
+        data = self._req_raw(
+            b'\x0c\x17\x08\x01\x01\x01\x0e\x00\x0e\x00\xc5\x0f' + _PKT_TRANSACTION.pack(market.value, stock.encode(),
+                                                                                        start, count))
+        count, = _U16.unpack_from(data)
+        # 实时成交数据每行末尾多一个保留的vint
+        return _parse_trades(data, 2, count, 5)
 
     def get_history_transaction_data(self, market: Market, stock: str, start: int, count: int, date: int) -> list[
-        dict[str, Any]]:
-        reader = self._req(
-            b'\x0c\x01\x30\x01\x00\x01\x12\x00\x12\x00\xb5\x0f' + struct.pack('<IH6sHH', date, market.value,
-                                                                              stock.encode(), start, count))
-        trades = []
-        count = reader.u16
-        reader.skip(4)
-        last_price = 0
-        for _ in range(count):
-            time = _get_time(reader)
-            last_price += reader.vint
-
-            trades.append({
-                '时间': time,
-                '价格': last_price / 100,
-                '成交量': reader.vint,
-                'num': reader.vint,
-                'buyorsell': reader.vint
-            })
-        return trades
+        Trade]:
+        data = self._req_raw(
+            b'\x0c\x01\x30\x01\x00\x01\x12\x00\x12\x00\xb5\x0f' + _PKT_HISTORY_TRANSACTION.pack(date, market.value,
+                                                                                                stock.encode(),
+                                                                                                start, count))
+        count, = _U16.unpack_from(data)
+        return _parse_trades(data, 6, count, 4)
 
     def get_company_info_entry(self, market: Market, stock: str) -> list[dict[str, Any]]:
         reader = self._req(
-            b'\x0c\x0f\x10\x9b\x00\x01\x0e\x00\x0e\x00\xcf\x02' + struct.pack('<H6sI', market.value, stock.encode(), 0))
+            b'\x0c\x0f\x10\x9b\x00\x01\x0e\x00\x0e\x00\xcf\x02' + _PKT_COMPANY_INFO_ENTRY.pack(market.value,
+                                                                                                stock.encode(), 0))
         count = reader.u16
 
-        entries = []
-        for _ in range(count):
-            entries.append({
-                '名称': reader.rpad_str(64),
-                '文件名': reader.rpad_str(80),
-                '起始': reader.u32,
-                '长度': reader.u32
-            })
-        return entries
+        return [{
+            '名称': reader.rpad_str(64),
+            '文件名': reader.rpad_str(80),
+            '起始': reader.u32,
+            '长度': reader.u32
+        } for _ in range(count)]
 
     def get_company_info_content(self, market: Market, stock: str, filename: str, start: int, length: int) -> str:
-        reader = self._req(b'\x0c\x07\x10\x9c\x00\x01\x68\x00\x68\x00\xd0\x02' + struct.pack('<H6sH80sIII',
-                                                                                             market.value,
-                                                                                             stock.encode(),
-                                                                                             0,
-                                                                                             filename.encode().ljust(80,
-                                                                                                                     b'\0'),
-                                                                                             start, length, 0))
+        reader = self._req(
+            b'\x0c\x07\x10\x9c\x00\x01\x68\x00\x68\x00\xd0\x02' + _PKT_COMPANY_INFO_CONTENT.pack(market.value,
+                                                                                                  stock.encode(),
+                                                                                                  0,
+                                                                                                  filename.encode(),
+                                                                                                  start, length, 0))
         _ = reader.read(10)
         length = reader.u16
         return reader.read(length).decode('gbk')
 
     def get_xdxr_info(self, market: Market, stock: str) -> list[dict[str, Any]]:
         reader = self._req(
-            b'\x0c\x1f\x18\x76\x00\x01\x0b\x00\x0b\x00\x0f\x00\x01\x00' + struct.pack('<B6s', market.value,
-                                                                                      stock.encode()))
+            b'\x0c\x1f\x18\x76\x00\x01\x0b\x00\x0b\x00\x0f\x00\x01\x00' + _PKT_STOCK.pack(market.value,
+                                                                                   stock.encode()))
         if len(reader) < 11:
             return []
 
-        _market = self.Market(reader.u8)
+        _market = _MARKETS[reader.u8]
         reader.skip(2)
         _code = reader.read(6).decode()
 
@@ -368,7 +487,7 @@ class Api:
 
         for _ in range(reader.u16):
             reader.skip(1 + 7)
-            date = self._get_datetime(self.KLineCategory.KDay, reader)
+            date = _get_daily_datetime(reader)
             category = self.XDXRCategory(reader.u8)
             entry = {
                 '日期': date,
@@ -408,55 +527,29 @@ class Api:
         return result
 
     def get_finance_info(self, market: Market, stock: str):
-        reader = self._req(
-            b'\x0c\x1f\x18\x76\x00\x01\x0b\x00\x0b\x00\x10\x00\x01\x00' + struct.pack('<B6s', market.value,
-                                                                                      stock.encode()))
-        reader.skip(2)
-        return {
-            '市场': self.Market(reader.u8),
-            '股票代码': reader.read(6).decode(),
-            '流动股本': reader.f32 * 10000,
-            '省': reader.u16,
-            '工业': reader.u16,
-            '更新日期': reader.u32,
-            'ipo_date': reader.u32,
-            '总股本': reader.f32 * 10000,
-            '国家股': reader.f32 * 10000,
-            '发起人法人股': reader.f32 * 10000,
-            '法人股': reader.f32 * 10000,
-            'B股': reader.f32 * 10000,
-            'H股': reader.f32 * 10000,
-            '职工股': reader.f32 * 10000,
-            '总资产': reader.f32 * 10000,
-            '流动资产': reader.f32 * 10000,
-            '固定资产': reader.f32 * 10000,
-            '无形资产': reader.f32 * 10000,
-            '股东人数': reader.f32 * 10000,
-            '流动负债': reader.f32 * 10000,
-            '长期负债': reader.f32 * 10000,
-            '资本公积金': reader.f32 * 10000,
-            '净资产': reader.f32 * 10000,
-            '主营收入': reader.f32 * 10000,
-            '主营利润': reader.f32 * 10000,
-            '营收账款': reader.f32 * 10000,
-            '营业利润': reader.f32 * 10000,
-            '投资收入': reader.f32 * 10000,
-            '经营现金流': reader.f32 * 10000,
-            '总现金流': reader.f32 * 10000,
-            '存活': reader.f32 * 10000,
-            '利润总和': reader.f32 * 10000,
-            '税后利润': reader.f32 * 10000,
-            '净利润': reader.f32 * 10000,
-            '未分配利润': reader.f32 * 10000,
-            '每股净资产': reader.f32,
-            'reserved2': reader.f32
+        data = self._req_raw(
+            b'\x0c\x1f\x18\x76\x00\x01\x0b\x00\x0b\x00\x10\x00\x01\x00' + _PKT_STOCK.pack(market.value,
+                                                                                   stock.encode()))
+        market_value, code, liquid_capital, province, industry, updated_date, ipo_date, *values = \
+            _FINANCE_INFO.unpack_from(data)
+        result = {
+            '市场': _MARKETS[market_value],
+            '股票代码': code.decode(),
+            '流动股本': liquid_capital * 10000,
+            '省': province,
+            '工业': industry,
+            '更新日期': updated_date,
+            'ipo_date': ipo_date
         }
+        result.update(zip(_FINANCE_INFO_KEYS, [value * 10000 for value in values[:-2]]))
+        result['每股净资产'], result['reserved2'] = values[-2:]
+        return result
 
     def read_day_file(self, file: BinaryIO) -> list[DataEntry]:
         reader = BinaryReader(file)
         result = []
         while not reader.eof:
-            result.append(DataEntry(self._get_datetime(self.KLineCategory.KDaily, reader),
+            result.append(DataEntry(_get_daily_datetime(reader),
                                     reader.u32,
                                     reader.u32,
                                     reader.u32,
@@ -470,7 +563,7 @@ class Api:
         reader = BinaryReader(file)
         result = []
         while not reader.eof:
-            result.append(DataEntry(self._get_datetime(self.KLineCategory.K1, reader),
+            result.append(DataEntry(_get_intraday_datetime(reader),
                                     reader.u32 / 100,
                                     reader.u32 / 100,
                                     reader.u32 / 100,
@@ -484,7 +577,7 @@ class Api:
         reader = BinaryReader(file)
         result = []
         while not reader.eof:
-            result.append(DataEntry(self._get_datetime(self.KLineCategory.K1, reader),
+            result.append(DataEntry(_get_intraday_datetime(reader),
                                     reader.f32,
                                     reader.f32,
                                     reader.f32,
@@ -494,49 +587,109 @@ class Api:
             reader.skip(4)
         return result
 
-    def _get_datetime(self, category: KLineCategory, reader: BinaryReader) -> datetime.datetime:
+    def _k_line_date_format(self, category: KLineCategory) -> tuple[struct.Struct, Callable[..., datetime.datetime]]:
+        # 循环前按类型选定一次日期格式，避免每行都重新判断
         if category.value < self.KLineCategory.KDaily.value or category in (
                 self.KLineCategory.PerMinute, self.KLineCategory.K1):
-            zipday = reader.u16
-            tminutes = reader.u16
-            return datetime.datetime((zipday >> 11) + 2004,
-                                     int((zipday % 2048) / 100),
-                                     (zipday % 2048) % 100,
-                                     int(tminutes / 60),
-                                     tminutes % 60)
-        else:
-            zipday = reader.u32
-            return datetime.datetime(zipday // 10000,
-                                     (zipday % 10000) // 100,
-                                     zipday % 100,
-                                     15)
+            return _K_LINE_INTRADAY_DATE, _intraday_datetime
+        return _K_LINE_DAILY_DATE, _daily_datetime
 
     def _req(self, data: bytes) -> BinaryReader:
+        return BinaryReader(io.BytesIO(self._req_raw(data)))
+
+    def _req_raw(self, data: bytes) -> bytes:
         if not self._client:
             raise RuntimeError('初始化时未提供服务器地址')
-        self._client.send(data)
-        recv = self._client.recv(self.RSP_HEADER_LENGTH)
-        _r1, _r2, _r3, zipped_size, unzipped_size = struct.unpack('<IIIHH', recv)
-        data = bytearray()
-        remained_size = zipped_size
-        while remained_size > 0:
-            tmp_data = self._client.recv(remained_size)
-            remained_size -= len(tmp_data)
-            data.extend(tmp_data)
+        with self._lock:
+            self._client.sendall(data)
+            return self._recv()
+
+    def _recv(self) -> bytes:
+        header = self._recv_exactly(self.RSP_HEADER_LENGTH)
+        _r1, _r2, _r3, zipped_size, unzipped_size = _RSP_HEADER.unpack(header)
+        data = self._recv_exactly(zipped_size)
         if zipped_size != unzipped_size:
-            data = zlib.decompress(data)
-        return BinaryReader(io.BytesIO(data))
+            # 已知解压后的大小，一次分配好输出缓冲区
+            # 每个响应都是独立的zlib流，而zlib模块不提供inflateReset，
+            # 复用同一个decompressobj无法跨响应解压，因此每次单独解压
+            return zlib.decompress(data, bufsize=unzipped_size)
+        return data
+
+    def _recv_exactly(self, size: int) -> bytes:
+        # 缓冲读取，包头和较小的包体通常一次系统调用即可读完
+        data = self._rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError('服务器已断开连接')
+        return data
 
     def heartbeat(self) -> None:
         # 发送心跳包
         # 无需理会返回结果
         self.get_stocks_count(self.Market.SH)
 
+    def close(self) -> None:
+        if not self._client:
+            return
+        try:
+            self._client.shutdown(socket.SHUT_RDWR)
+        except OSError:  # 连接可能已被服务器断开
+            pass
+        self._rfile.close()
+        self._client.close()
+        self._client = None
+        self._rfile = None
+
     def __enter__(self) -> 'Api':
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        pass
+        self.close()
+
+
+class ApiPool:
+    # 预先建立size个已完成握手的连接，供多个线程借用
+    # 借用期间连接出错时将其关闭，下次借出时再重新建立
+    _pool: queue.Queue
+
+    def __init__(self, server: tuple[str, int], size: int, connection_timeout: float = 1.0) -> None:
+        self._server = server
+        self._connection_timeout = connection_timeout
+        self._pool = queue.Queue()
+        for _ in range(size):
+            self._pool.put(Api(server, connection_timeout))
+
+    @contextlib.contextmanager
+    def borrowed(self) -> Iterator[Api]:
+        api = self._pool.get()
+        try:
+            if api is None:
+                api = Api(self._server, self._connection_timeout)
+            yield api
+        except OSError:
+            if api is not None:
+                api.close()
+                api = None
+            raise
+        finally:
+            self._pool.put(api)
+
+    def close(self) -> None:
+        while True:
+            try:
+                api = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            if api is not None:
+                api.close()
+
+    def __enter__(self) -> 'ApiPool':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
 
+# 按协议中的数值查找市场，避免每次构造枚举
+_MARKETS = {market.value: market for market in Api.Market}
 
-__all__ = ['Api']
+__all__ = ['Api', 'ApiPool']